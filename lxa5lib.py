@@ -3,6 +3,7 @@
 from collections import Counter
 import sys
 import json
+import heapq
 from pathlib import Path
 from distutils.util import strtobool
 from collections import OrderedDict
@@ -355,6 +356,37 @@ def json_pdump(inputdict, outfile,
               indent=indent, separators=separators)
 
 
+def json_pdump_stream(inputdict, outfile,
+                      key=lambda x:x, reverse=False,
+                      ensure_ascii=False):
+    """json pretty dump, streaming one entry at a time
+
+    Writes the same kind of output as json_pdump (str keys and values,
+    entries sorted by "key") but serializes entry by entry instead of
+    building the sorted intermediate dict plus the full output string
+    in memory first. Useful for the large dicts such as WordToContexts
+    whose values can hold millions of entries.
+    """
+
+    if reverse:
+        items = heapq.nlargest(len(inputdict), inputdict.items(), key=key)
+    else:
+        items = heapq.nsmallest(len(inputdict), inputdict.items(), key=key)
+
+    outfile.write('{')
+    first = True
+    for k, v in items:
+        if first:
+            first = False
+        else:
+            outfile.write(',')
+        outfile.write('\n    ')
+        outfile.write(json.dumps(str(k), ensure_ascii=ensure_ascii))
+        outfile.write(': ')
+        outfile.write(json.dumps(str(v), ensure_ascii=ensure_ascii))
+    outfile.write('\n}')
+
+
 def json_pload(infile):
     '''json pretty load'''
     outdict = json.load(infile)
@@ -12,15 +12,17 @@
 
 import argparse
 from pathlib import Path
-from collections import OrderedDict
 import sys
 import json
+import hashlib
+import pickle
 
+import numpy as np
+import scipy.sparse
 import networkx as nx
 from networkx.readwrite import json_graph
 
 from manifold_module import (GetMyWords, GetContextArray,
-                             Normalize, compute_incidence_graph,
                              compute_laplacian, GetEigenvectors,
                              compute_words_distance, compute_closest_neighbors,
                              compute_WordToSharedContextsOfNeighbors,
@@ -30,6 +32,7 @@ import ngrams
 import lxa5
 
 from lxa5lib import (get_language_corpus_datafolder, json_pdump,
+                     json_pdump_stream,
                      changeFilenameSuffix, stdout_list, json_pload,
                      load_config_for_command_line_help,
                      SEP_SIG, SEP_SIGTRANSFORM)
@@ -79,6 +82,35 @@ def makeArgParser(configfilename="config.json"):
     return parser
 
 
+def get_spectral_coordinates(context_array, nWordsForAnalysis, nEigenvectors):
+    """Run the spectral stages -- shared context matrix, laplacian,
+    eigenvectors -- and return the word coordinates.
+
+    Keeping these stages in their own scope lets the large intermediate
+    matrices die as soon as this function returns, which is more reliable
+    than the chain of del statements main used to carry (and works even
+    if one of the stages raises).
+    """
+
+    print("Computing shared context master matrix...", flush=True)
+    # keep the word-by-word shared context matrix sparse (csr dot csr is csr);
+    # the context array is typically way below 1% dense, so materializing
+    # the full dense product here wastes both time and memory.
+    # Densification happens lazily inside compute_laplacian,
+    # the one place where dense access is needed.
+    CountOfSharedContexts = context_array @ context_array.T
+
+    print("Computing mylaplacian...", flush=True)
+    # the laplacian stays sparse all the way into the eigensolver
+    mylaplacian = compute_laplacian(nWordsForAnalysis, CountOfSharedContexts)
+
+    print("Computing eigenvectors...", flush=True)
+    myeigenvalues, myeigenvectors = GetEigenvectors(mylaplacian, nEigenvectors)
+
+    # the eigensolver returns exactly nEigenvectors columns
+    return myeigenvectors
+
+
 def main(language=None, corpus=None, datafolder=None, filename=None,
          maxwordtypes=1000, nNeighbors=9, nEigenvectors=11, 
          create_WordToContexts=False, create_ContextToWords=False,
@@ -92,11 +124,13 @@ def main(language=None, corpus=None, datafolder=None, filename=None,
         infolder = Path(Path(filename).parent, 'ngrams')
         outfolder = Path(Path(filename).parent, 'neighbors')
         outcontextsfolder = Path(Path(filename).parent, 'word_contexts')
+        cachefolder = Path(Path(filename).parent, 'context_cache')
     else:
         corpusStem = Path(corpus).stem
         infolder = Path(datafolder, language, 'ngrams')
         outfolder = Path(datafolder, language, 'neighbors')
         outcontextsfolder = Path(datafolder, language, 'word_contexts')
+        cachefolder = Path(datafolder, language, 'context_cache')
 
     if not outfolder.exists():
         outfolder.mkdir(parents=True)
@@ -169,64 +203,76 @@ def main(language=None, corpus=None, datafolder=None, filename=None,
     outContextToWords_json = Path(outcontextsfolder, corpusName + \
                                        "_ContextToWords.json")
 
-    print("Reading bigrams/trigrams and computing context array...", flush=True)
-
-    context_array, contextdict, \
-    WordToContexts, ContextToWords = GetContextArray(nWordsForAnalysis,
-        worddict, infileBigramsname, infileTrigramsname, mincontexts)
-
-    print("Computing shared context master matrix...", flush=True)
-    CountOfSharedContexts = context_array.dot(context_array.T).todense()
-    del context_array
+    # The context array cache is keyed on the corpus, the parameters that
+    # shape the array, and the n-gram files' modification times, so re-runs
+    # that only tune nNeighbors or nEigenvectors skip the parse stage.
+    cache_sig = hashlib.sha1("{}|{}|{}|{}|{}|{}".format(
+                    corpusStem, nWordsForAnalysis, mincontexts,
+                    infileWordsname.stat().st_mtime,
+                    infileBigramsname.stat().st_mtime,
+                    infileTrigramsname.stat().st_mtime).encode()
+                ).hexdigest()[:12]
+    cacheStem = corpusStem + '_' + cache_sig
+    cache_array_fname = Path(cachefolder, cacheStem + '_contextarray.npz')
+    cache_dicts_fname = Path(cachefolder, cacheStem + '_contextdicts.pkl')
+
+    if cache_array_fname.exists() and cache_dicts_fname.exists():
+        print("Reading cached context array...", flush=True)
+        context_array = scipy.sparse.load_npz(str(cache_array_fname))
+        with cache_dicts_fname.open('rb') as f:
+            contextdict, WordToContexts, ContextToWords = pickle.load(f)
+    else:
+        print("Reading bigrams/trigrams and computing context array...",
+              flush=True)
 
-    print("Computing diameter...", flush=True)
-    Diameter = Normalize(nWordsForAnalysis, CountOfSharedContexts)
+        context_array, contextdict, \
+        WordToContexts, ContextToWords = GetContextArray(nWordsForAnalysis,
+            worddict, infileBigramsname, infileTrigramsname, mincontexts)
 
-    print("Computing incidence graph...", flush=True)
-    incidencegraph = compute_incidence_graph(nWordsForAnalysis, Diameter,
-                                             CountOfSharedContexts)
-    del CountOfSharedContexts
+        if not cachefolder.exists():
+            cachefolder.mkdir(parents=True)
+        scipy.sparse.save_npz(str(cache_array_fname), context_array)
+        with cache_dicts_fname.open('wb') as f:
+            pickle.dump((contextdict, WordToContexts, ContextToWords), f)
 
-    print("Computing mylaplacian...", flush=True)
-    mylaplacian = compute_laplacian(nWordsForAnalysis, Diameter, incidencegraph)
-    del Diameter
-    del incidencegraph
-
-    print("Computing eigenvectors...", flush=True)
-    myeigenvalues, myeigenvectors = GetEigenvectors(mylaplacian)
-    del mylaplacian
-    del myeigenvalues
+    coordinates = get_spectral_coordinates(context_array, nWordsForAnalysis,
+                                           nEigenvectors)
 
     print('Computing distances between words...', flush=True)
-    # take first N columns of eigenvector matrix
-    coordinates = myeigenvectors[:,:nEigenvectors] 
-    wordsdistance = compute_words_distance(nWordsForAnalysis, coordinates)
-    del coordinates
+    # The distance matrix is the only dense N-by-N array in the pipeline;
+    # preallocate it so compute_words_distance works fully in place.
+    workbuf = np.empty((nWordsForAnalysis, nWordsForAnalysis), dtype=np.float32)
+    wordsdistance = compute_words_distance(nWordsForAnalysis, coordinates,
+                                           out=workbuf)
 
     print('Computing nearest neighbors now... ', flush=True)
     closestNeighbors = compute_closest_neighbors(wordsdistance, nNeighbors)
 
-    WordToNeighbors_by_str = OrderedDict()
-    WordToNeighbors = dict()
+    # one fancy-indexing call maps the whole neighbor index matrix to the
+    # corresponding words, instead of a Python loop over N rows.
+    # Row k of closestNeighbors is word index k followed by its neighbors,
+    # so the rows line up with analyzedwordlist.
+    neighbors_idx = closestNeighbors[:, 1:]
+    words_arr = np.array(analyzedwordlist, dtype=object)
 
-    for wordno in range(nWordsForAnalysis):
-        line = closestNeighbors[wordno]
-        word_idx, neighbors_idx = line[0], line[1:]
-        word = analyzedwordlist[word_idx]
-        neighbors = [analyzedwordlist[idx] for idx in neighbors_idx]
-        WordToNeighbors_by_str[word] = neighbors
-        WordToNeighbors[word_idx] = neighbors_idx
-
-    del closestNeighbors
+    # a plain dict keeps insertion order on Python 3.7+, so OrderedDict
+    # buys nothing here
+    WordToNeighbors_by_str = dict(zip(analyzedwordlist,
+                                      words_arr[neighbors_idx].tolist()))
+    WordToNeighbors = dict(enumerate(neighbors_idx.tolist()))
 
     with outfilenameNeighbors.open('w') as f:
-        print("# language: {}\n# corpus: {}\n"
-              "# Number of word types analyzed: {}\n"
-              "# Number of neighbors: {}\n".format(language, corpus,
-                                         nWordsForAnalysis, nNeighbors), file=f)
-
-        for word, neighbors in WordToNeighbors_by_str.items():
-            print(word, " ".join(neighbors), file=f)
+        f.write("# language: {}\n# corpus: {}\n"
+                "# Number of word types analyzed: {}\n"
+                "# Number of neighbors: {}\n\n".format(language, corpus,
+                                           nWordsForAnalysis, nNeighbors))
+
+        # one buffered write for the whole block instead of a print
+        # (and its write syscalls) per word
+        f.write("\n".join(word + " " + " ".join(neighbors)
+                          for word, neighbors in
+                          WordToNeighbors_by_str.items()))
+        f.write("\n")
 
     neighbor_graph = GetMyGraph(WordToNeighbors_by_str)
 
@@ -234,12 +280,16 @@ def main(language=None, corpus=None, datafolder=None, filename=None,
     nx.write_gexf(neighbor_graph, str(outfilenameNeighborGraph))
 
     # output manifold as json for d3 visualization
+    # (the with blocks here and below make sure the file handles are
+    # closed promptly even if serialization raises halfway through)
     manifold_json_data = json_graph.node_link_data(neighbor_graph)
     outfilenameManifoldJson = Path(outfolder, corpusName + "_manifold.json")
-    json.dump(manifold_json_data, outfilenameManifoldJson.open("w"), indent=2)
+    with outfilenameManifoldJson.open("w") as f:
+        json.dump(manifold_json_data, f, indent=2)
 
     WordToNeighbors_json = changeFilenameSuffix(outfilenameNeighbors, ".json")
-    json_pdump(WordToNeighbors_by_str, WordToNeighbors_json.open("w"), asis=True)
+    with WordToNeighbors_json.open("w") as f:
+        json_pdump(WordToNeighbors_by_str, f, asis=True)
 
     print("Computing shared contexts among neighbors...", flush=True)
     WordToSharedContextsOfNeighbors, \
@@ -264,13 +314,15 @@ def main(language=None, corpus=None, datafolder=None, filename=None,
 
     if create_WordToContexts:
         outputfilelist.append(outWordToContexts_json)
-        json_pdump(WordToContexts, outWordToContexts_json.open("w"),
-                   key=lambda x : len(x[1]), reverse=True)
+        with outWordToContexts_json.open("w") as f:
+            json_pdump_stream(WordToContexts, f,
+                              key=lambda x : len(x[1]), reverse=True)
 
     if create_ContextToWords:
         outputfilelist.append(outContextToWords_json)
-        json_pdump(ContextToWords, outContextToWords_json.open("w"),
-                   key=lambda x : len(x[1]), reverse=True)
+        with outContextToWords_json.open("w") as f:
+            json_pdump_stream(ContextToWords, f,
+                              key=lambda x : len(x[1]), reverse=True)
 
     stdout_list("Output files:", *outputfilelist)
 
@@ -10,23 +10,19 @@
 #-----------------------------------------------------------------------#
 
 from collections import (OrderedDict, defaultdict, Counter)
+from concurrent.futures import ThreadPoolExecutor
 from itertools import combinations
 from pathlib import Path
+import os
 
 import numpy as np
 import scipy.spatial
 import scipy.sparse
+import scipy.sparse.csgraph
 import networkx as nx
 
 from lxa5lib import sorted_alphabetized
 
-def Normalize(NumberOfWordsForAnalysis, CountOfSharedContexts):
-    arr = np.ones((NumberOfWordsForAnalysis), dtype=np.int64)
-    for word_no in range(NumberOfWordsForAnalysis):
-        arr[word_no] = np.sum(CountOfSharedContexts[word_no]) - \
-                       CountOfSharedContexts[word_no, word_no]
-    return arr
-
 def hasGooglePOSTag(line, corpus):
     if corpus == 'google':
         for tag in ['_NUM', '_ADP', '_ADJ', '_VERB', '_NOUN',
@@ -61,142 +57,197 @@ def GetMyWords(infileWordsname, corpus, minWordFreq=1):
 
 def GetMyGraph(WordToNeighbors_by_str, useWeights=None):
     G = nx.Graph()
-    for word in WordToNeighbors_by_str.keys():
-        neighbors = WordToNeighbors_by_str[word] # a list
-        for neighbor in neighbors:
-            G.add_edge(word, neighbor)
+    G.add_edges_from((word, neighbor)
+                     for word, neighbors in WordToNeighbors_by_str.items()
+                     for neighbor in neighbors)
     return G
 
 
 def GetContextArray(nwords, worddict,
                     infileBigramsname, infileTrigramsname, mincontexts):
 
-    # this is necessary so we can reference variables from inner functions
-    class Namespace:
-        pass
-    ns = Namespace()
-    # more notes: We use "ncontexts" to keep track of how many unique contexts
-    # there are. Conveniently, ncontexts also serves to provide a unique context
-    # index whenever the program encounters a new context. The dummy class
-    # Namespace is to make it possible that we can refer to and update ncontexts
-    # within inner functions (both "contexts_incr" and "addword")
-    # inside this "GetContextArray" function.
-
-    ns.ncontexts = 0
-    def contexts_incr():
-        tmp = ns.ncontexts
-        ns.ncontexts += 1
-        return tmp
-
-    contextdict = defaultdict(contexts_incr)
-    # key: context (tuple, e.g. ("of", "_", "cat") as a trigram context for "the"
-    # value: context index (int)
-    # This dict is analogous to worddict, where each key is a word (str)
-    # and each value is a word index (int).
-
-    # entries for sparse matrix
-    rows = [] # row numbers are word indices
-    cols = [] # column numbers are context indices
-    vals = [] 
-
-    # both WordToContexts and ContextToWords use integers as indices and do NOT
-    # store strings directly
-    # so WordToContexts maps word indices to context indices
-    # and ContextToWords maps context indices to word indices
-    # we need the indices anyway, because of the use of scipy sparse matrix
-    # and we keep this indexing approach for memory efficiency
-    # (e.g., avoid direct string comparison)
-
-    WordToContexts = defaultdict(Counter)
-    ContextToWords = defaultdict(Counter)
-
-    def addword(word, context, occurrence_count):
-        word_no = worddict[word] # w is a word index
-        context_no = contextdict[context] # c is a context index
-        rows.append(word_no)
-        cols.append(context_no)
-        vals.append(1) # if we use 1, we assume "type" counts.
-                       # What if we use occurrence_count (--> "token" counts)?
-
-        WordToContexts[word_no][context_no] += occurrence_count
-        ContextToWords[context_no][word_no] += occurrence_count
+    # Contexts used to be Python tuples like ("of", "_", "cat"), hashed in
+    # a dict once per n-gram occurrence -- millions of tuple hashes on a
+    # large corpus. Instead, every token gets a small integer id as it is
+    # first seen, and each context is packed into a single int64:
+    # a 4-bit code for the gap position (which also tells bigram from
+    # trigram contexts apart) and two 30-bit token ids. Assigning context
+    # indices then becomes one sort-based np.unique call over the packed
+    # keys, and only the unique contexts are ever decoded back to tuples.
+
+    tokendict = dict() # token (str) to token id (int)
+    tokenlist = []     # token id back to token
+    def get_token_id(token):
+        token_id = tokendict.get(token)
+        if token_id is None:
+            token_id = len(tokenlist)
+            tokendict[token] = token_id
+            tokenlist.append(token)
+        return token_id
+
+    # gap position codes for the packed context keys
+    # 0: ('_', w2, w3)    1: (w1, '_', w3)    2: (w1, w2, '_')
+    # 3: ('_', w2)        4: (w1, '_')
+
+    entry_words = []    # word index of each (word, context) occurrence
+    entry_contexts = [] # packed context key of each occurrence
+    entry_counts = []   # occurrence count of the n-gram it came from
+
+    # The loops below are the hot path of this function -- they run once
+    # per line over two potentially huge n-gram files. Local aliases for
+    # the append methods and the dict lookups keep the per-line work down
+    # to one split, one int() and a few dict operations plus integer
+    # arithmetic.
+    words_append = entry_words.append
+    contexts_append = entry_contexts.append
+    counts_append = entry_counts.append
+    get_word_no = worddict.get
 
     with infileTrigramsname.open() as trigramfile:
         for line in trigramfile:
-            line = line.strip()
-            if (not line) or line.startswith('#'):
+            if line.startswith('#'):
                 continue
             line_components = line.split()
+            if len(line_components) != 4:
+                continue
 
-            word1 = line_components[0]
-            word2 = line_components[1]
-            word3 = line_components[2]
-            occurrence_count = int(line_components[3])
+            word1, word2, word3, count_str = line_components
+            occurrence_count = int(count_str)
 
             if occurrence_count < mincontexts:
                 continue
 
-            context1 = tuple(['_', word2, word3])
-            context2 = tuple([word1, '_', word3])
-            context3 = tuple([word1, word2, '_'])
-
-            if worddict.get(word1) is not None:
-                addword(word1, context1, occurrence_count)
-            if worddict.get(word2) is not None:
-                addword(word2, context2, occurrence_count)
-            if worddict.get(word3) is not None:
-                addword(word3, context3, occurrence_count)
+            id1 = get_token_id(word1)
+            id2 = get_token_id(word2)
+            id3 = get_token_id(word3)
+
+            word_no = get_word_no(word1)
+            if word_no is not None:
+                words_append(word_no)
+                contexts_append((id2 << 30) | id3)
+                counts_append(occurrence_count)
+            word_no = get_word_no(word2)
+            if word_no is not None:
+                words_append(word_no)
+                contexts_append((1 << 60) | (id1 << 30) | id3)
+                counts_append(occurrence_count)
+            word_no = get_word_no(word3)
+            if word_no is not None:
+                words_append(word_no)
+                contexts_append((2 << 60) | (id1 << 30) | id2)
+                counts_append(occurrence_count)
 
     with infileBigramsname.open() as bigramfile:
         for line in bigramfile:
-            line = line.strip()
-            if (not line) or line.startswith('#'):
+            if line.startswith('#'):
                 continue
             line_components = line.split()
+            if len(line_components) != 3:
+                continue
 
-            word1 = line_components[0]
-            word2 = line_components[1]
-            occurrence_count = int(line_components[2])
+            word1, word2, count_str = line_components
+            occurrence_count = int(count_str)
 
             if occurrence_count < mincontexts:
                 continue
 
-            context1 = tuple(['_', word2])
-            context2 = tuple([word1, '_'])
-
-            if worddict.get(word1) is not None:
-                addword(word1, context1, occurrence_count)
-            if worddict.get(word2) is not None:
-                addword(word2, context2, occurrence_count)
-
-    # csr_matrix in scipy means compressed matrix
-    return ( scipy.sparse.csr_matrix((vals,(rows,cols)),
-                shape=(nwords, ns.ncontexts+1), dtype=np.int64 ),
-             contextdict, WordToContexts, ContextToWords )
-
-
-def counting_context_features(context_array):
-    return np.dot(context_array, context_array.T) 
+            id1 = get_token_id(word1)
+            id2 = get_token_id(word2)
+
+            word_no = get_word_no(word1)
+            if word_no is not None:
+                words_append(word_no)
+                contexts_append((3 << 60) | id2)
+                counts_append(occurrence_count)
+            word_no = get_word_no(word2)
+            if word_no is not None:
+                words_append(word_no)
+                contexts_append((4 << 60) | id1)
+                counts_append(occurrence_count)
+
+    entry_words = np.array(entry_words, dtype=np.int64)
+    entry_counts = np.array(entry_counts, dtype=np.int64)
+    packed = np.array(entry_contexts, dtype=np.int64)
+
+    # one vectorized unique call assigns a context index to every
+    # occurrence, replacing the per-occurrence dict insertions
+    unique_contexts, context_indices = np.unique(packed, return_inverse=True)
+    ncontexts = len(unique_contexts)
+
+    # contextdict maps each context tuple, e.g. ("of", "_", "cat") as a
+    # trigram context for "the", to its context index (int).
+    # This dict is analogous to worddict, where each key is a word (str)
+    # and each value is a word index (int).
+    # Only the unique contexts need decoding from their packed keys.
+    low30 = (1 << 30) - 1
+    contextdict = dict()
+    for context_no, key in enumerate(unique_contexts.tolist()):
+        gap_pos, a, b = key >> 60, (key >> 30) & low30, key & low30
+        if gap_pos == 0:
+            context = ('_', tokenlist[a], tokenlist[b])
+        elif gap_pos == 1:
+            context = (tokenlist[a], '_', tokenlist[b])
+        elif gap_pos == 2:
+            context = (tokenlist[a], tokenlist[b], '_')
+        elif gap_pos == 3:
+            context = ('_', tokenlist[b])
+        else:
+            context = (tokenlist[b], '_')
+        contextdict[context] = context_no
 
+    # both WordToContexts and ContextToWords use integers as indices and do NOT
+    # store strings directly
+    # so WordToContexts maps word indices to context indices
+    # and ContextToWords maps context indices to word indices
+    # we need the indices anyway, because of the use of scipy sparse matrix
+    # and we keep this indexing approach for memory efficiency
+    # (e.g., avoid direct string comparison)
+    # The occurrence counts per (word, context) pair are summed with
+    # bincount over the unique pairs, so the Python loop below only runs
+    # once per distinct pair instead of once per occurrence.
 
-def compute_incidence_graph(NumberOfWordsForAnalysis, Diameter, CountOfSharedContexts):
-    incidencegraph= np.asarray(CountOfSharedContexts, dtype=np.int64)
+    WordToContexts = defaultdict(Counter)
+    ContextToWords = defaultdict(Counter)
 
-    for word_no in range(NumberOfWordsForAnalysis):
-        incidencegraph[word_no, word_no] = Diameter[word_no]
-    return incidencegraph
+    pairs = (entry_words << 32) | context_indices
+    unique_pairs, pair_indices = np.unique(pairs, return_inverse=True)
+    pair_counts = np.bincount(pair_indices,
+                              weights=entry_counts).astype(np.int64)
 
+    for pair_key, c in zip(unique_pairs.tolist(), pair_counts.tolist()):
+        word_no, context_no = pair_key >> 32, pair_key & 0xffffffff
+        WordToContexts[word_no][context_no] = c
+        ContextToWords[context_no][word_no] = c
 
+    # csr_matrix in scipy means compressed matrix
+    # float32 (instead of int64 or float64) is plenty for these counts and
+    # halves the memory traffic of everything downstream in the pipeline.
+    # Each cell gets 1 per contributing n-gram line (the csr constructor
+    # sums duplicate entries) -- i.e. "type" counts, as before.
+    # What if we use occurrence_count (--> "token" counts)?
+    vals = np.ones(len(entry_words), dtype=np.float32)
+    return ( scipy.sparse.csr_matrix((vals, (entry_words, context_indices)),
+                shape=(nwords, ncontexts+1), dtype=np.float32 ),
+             contextdict, WordToContexts, ContextToWords )
 
-def compute_laplacian(NumberOfWordsForAnalysis, Diameter, incidencegraph): 
-    D = np.sqrt(np.outer(Diameter, Diameter))
-    # we want to NOT have div-by-zero errors,
-    # but if D[i,j] = 0 then incidencegraph[i,j] = 0 too.
-    D[D==0] = 1
 
-    # broadcasts the multiplication, so A[i,j] = B[i,j] * C[i, j]
-    mylaplacian = (1/D) * incidencegraph 
-    return mylaplacian
+def counting_context_features(context_array):
+    # np.dot on a scipy sparse matrix goes through the deprecated
+    # np.matrix machinery; the @ operator keeps the product sparse
+    return context_array @ context_array.T
+
+
+def compute_laplacian(NumberOfWordsForAnalysis, CountOfSharedContexts):
+    # scipy's csgraph.laplacian builds the symmetric normalized laplacian
+    # D^{-1/2} (D - A) D^{-1/2} in compiled code straight from the sparse
+    # shared context matrix; the matrix's own diagonal (each word's
+    # contexts shared with itself) is treated as self loops and ignored,
+    # which matches the diameter computation this replaces.
+    # The result stays sparse; csgraph.laplacian hands back COO, which is
+    # converted to CSR here so the eigensolver's matvecs stay O(nnz)
+    # without another format conversion downstream.
+    return scipy.sparse.csgraph.laplacian(
+               CountOfSharedContexts.astype(np.float32), normed=True).tocsr()
 
 def compute_coordinates(NumberOfWordsForAnalysis, NumberOfEigenvectors, myeigenvectors):
     Coordinates = dict()
@@ -208,25 +259,89 @@ def compute_coordinates(NumberOfWordsForAnalysis, NumberOfEigenvectors, myeigenv
 
 
 
-def compute_words_distance(nwords, coordinates):
-    # the scipy pdist function is to compute pairwise distances
-    return scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(coordinates, "euclidean"))
+def compute_words_distance(nwords, coordinates, out=None):
+    # pairwise euclidean distances via the identity
+    #     ||x - y||^2  =  ||x||^2 + ||y||^2 - 2 x.y
+    # so that the heavy lifting is one matrix product handled by BLAS,
+    # instead of pdist plus a squareform round trip.
+    # All N-by-N arithmetic happens in place in "out" (allocated here
+    # if the caller doesn't pass a reusable buffer).
+    coordinates = np.ascontiguousarray(coordinates, dtype=np.float32)
+
+    if out is None:
+        out = np.empty((nwords, nwords), dtype=np.float32)
+
+    sq = np.einsum('ij,ij->i', coordinates, coordinates)
+
+    def fill_block(start, stop):
+        block = out[start:stop]
+        np.dot(coordinates[start:stop], coordinates.T, out=block)
+        block *= -2
+        block += sq[start:stop, np.newaxis]
+        block += sq[np.newaxis, :]
+        # rounding can push tiny true-zero distances slightly negative
+        np.maximum(block, 0, out=block)
+        np.sqrt(block, out=block)
+
+    # numpy releases the GIL inside the matrix product and the ufunc
+    # loops, so threads (much cheaper than worker processes) give real
+    # multi-core scaling on independent row blocks
+    nworkers = os.cpu_count() or 1
+    if nworkers == 1 or nwords < 256:
+        fill_block(0, nwords)
+    else:
+        blocksize = -(-nwords // nworkers) # ceiling division
+        with ThreadPoolExecutor(nworkers) as pool:
+            futures = [pool.submit(fill_block, start,
+                                   min(start + blocksize, nwords))
+                       for start in range(0, nwords, blocksize)]
+            for future in futures:
+                future.result()
+
+    return out
 
 
 def compute_closest_neighbors(wordsdistance, NumberOfNeighbors):
-    sortedNeighbors = wordsdistance.argsort() # indices of sorted rows, low to high
-    # truncate columns at NumberOfNeighbors+1 
-    closestNeighbors = sortedNeighbors[:,:NumberOfNeighbors+1] 
+    nwords = wordsdistance.shape[0]
+    k = min(NumberOfNeighbors, nwords - 1)
+
+    # push each word's self-distance out of the running
+    # (note that this writes into the caller's distance matrix)
+    np.fill_diagonal(wordsdistance, np.inf)
+
+    # argpartition is O(N) per row where a full argsort is O(N log N);
+    # only the k selected entries per row still need sorting afterwards
+    neighbors = np.argpartition(wordsdistance, k, axis=1)[:, :k]
+    rowdistance = np.take_along_axis(wordsdistance, neighbors, axis=1)
+    order = np.argsort(rowdistance, axis=1)
+    neighbors = np.take_along_axis(neighbors, order, axis=1)
+
+    # each row starts with the word index itself, followed by its
+    # nearest neighbors -- the same layout argsort used to produce
+    closestNeighbors = np.hstack((np.arange(nwords)[:, np.newaxis], neighbors))
     return closestNeighbors
 
 
-def GetEigenvectors(laplacian):
-    # csr_matrix in scipy means compressed matrix
-    laplacian_sparse = scipy.sparse.csr_matrix(laplacian)
+def GetEigenvectors(laplacian, nEigenvectors):
+    # csr_matrix in scipy means compressed matrix.
+    # The laplacian normally arrives as float32 CSR already, in which
+    # case both conversions below are no-ops; a dense or non-CSR input
+    # still works.
+    if not scipy.sparse.issparse(laplacian):
+        laplacian = scipy.sparse.csr_matrix(laplacian)
+    laplacian_sparse = laplacian.tocsr().astype(np.float32, copy=False)
 
     # linalg is the linear algebra module in scipy
-    # eigs takes a matrix and returns (array of eigenvalues, array of eigenvectors)
-    return scipy.sparse.linalg.eigs(laplacian_sparse)
+    # eigsh uses the Lanczos method for symmetric matrices and computes
+    # only the nEigenvectors eigenpairs we actually need, instead of a
+    # full (and much more expensive) eigendecomposition. The input is
+    # now the true normalized laplacian, whose spectrum is the old
+    # matrix's mirrored, so the smallest eigenpairs ('SM') span the
+    # same embedding subspace the large end ('LA') did before.
+    # k must be strictly smaller than the matrix dimension.
+    k = min(nEigenvectors, laplacian_sparse.shape[0] - 1)
+    return scipy.sparse.linalg.eigsh(laplacian_sparse, k=k, which='SM',
+                                     tol=1e-4, maxiter=500)
 
 
 def compute_WordToSharedContextsOfNeighbors(nWordsForAnalysis, WordToContexts,